@@ -11,6 +11,12 @@ from optparse import OptionParser
 
 import sys, os, os.path
 import tempfile, shutil
+import mmap, io
+import hashlib, threading, binascii
+from collections import defaultdict
+from operator import attrgetter
+from multiprocessing import cpu_count
+from multiprocessing.dummy import Pool as ThreadPool
 
 import tarfile
 try:
@@ -29,6 +35,8 @@ getopt.add_option('-v', '--verbose', action = 'store_true', dest = 'verbose', de
 		help = "Print filenames as they are appended (like 'tar -v')")
 getopt.add_option('-m', '--nomagic', action = 'store_false', dest = 'usemagic', default = True,
 		help = 'Disable time consuming recognition of filetype using magic')
+getopt.add_option('-f', '--fast-magic', action = 'store_true', dest = 'fastmagic', default = False,
+		help = 'Group files by their first bytes instead of using magic')
 getopt.add_option('-q', '--quiet', action = 'store_true', dest = 'quiet', default = False,
 		help = 'Silence all errors')
 getopt.add_option('-d', '--debug', action = 'count', dest = 'debug', default = 0,
@@ -43,10 +51,13 @@ if len(args) < 1:
 elif len(args) > 1 and opts.out:
 	getopt.error('--output can be used with only one input file.')
 
-if opts.usemagic:
+if opts.usemagic and not opts.fastmagic:
 	if have_magic:
-		wizard = magic.open(magic.MAGIC_MIME | magic.MAGIC_COMPRESS)
-		wizard.load()
+		# magic cookies can't be shared between threads, so each worker
+		# opens its own; the pool and cookies are reused for all files
+		wizards = threading.local()
+		cookies = []
+		magicpool = ThreadPool(cpu_count())
 	else:
 		sys.stderr.write("Unable to import 'magic' module, assuming --nomagic.\n")
 		opts.usemagic = False
@@ -59,88 +70,261 @@ class reorder_by:
 
 reorder_by_descs = [None, 'filetype', 'extensions', 'filenames', 'full paths']
 
+# TarInfo.type values, checked directly instead of calling TarInfo.is*()
+regtypes = frozenset(tarfile.REGULAR_TYPES)
+dirtype = tarfile.DIRTYPE
+sparsetype = tarfile.GNUTYPE_SPARSE
+
+# sort key for TarInfo lists
+byname = attrgetter('name')
+
+# I/O buffer size, tarfile itself writes in 512-byte blocks
+bufsize = 1 << 20
+
 def debug(lv, msg):
 	""" Output debug message if debuglevel is appropriate. """
 	if opts.debug >= lv:
 		sys.stderr.write("-*- %s%s\n" % ('\t' * (lv - 1), msg))
 
-def reorder(inlist, crit, intar, outtar, key):
-	""" Perform the reorder of files in 'inlist' using criteria 'crit'. """
-	def copy(flist):
-		""" Copy files in 'flist' into new tarball. """
-		for f in flist:
-			if opts.verbose:
-				print f.name
+def openout(fn, cls):
+	""" Open 'fn' for buffered writing, using file class 'cls'. """
+	if cls is file:
+		return io.open(fn, 'wb', buffering = bufsize)
 
-			if f.isreg():
-				fc = intar.extractfile(f)
-				outtar.addfile(f, fc)
-			else:
-				outtar.addfile(f)
+	f = cls(fn, 'wb')
+	if isinstance(f, io.IOBase): # GzipFile is, BZ2File is not
+		f = io.BufferedWriter(f, bufsize)
+	return f
 
-	out = {}
-	before = []
-	after = []
+def mapfile(f):
+	""" Map file 'f' into memory (read-only), return None if not possible. """
+	try:
+		return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+	except (EnvironmentError, ValueError, OverflowError):
+		return None
+
+def copydata(src, dst, size):
+	""" Copy 'size' bytes from file 'src' to 'dst'. """
+	while size > 0:
+		buf = src.read(min(size, bufsize))
+		if not buf:
+			raise IOError('unexpected end of data')
+		dst.write(buf)
+		size -= len(buf)
+
+def recognize(buf):
+	""" Recognize filetype of 'buf' using magic cookie of current thread. """
+	try:
+		wizard = wizards.cookie
+	except AttributeError:
+		wizard = wizards.cookie = magic.open(magic.MAGIC_MIME | magic.MAGIC_COMPRESS)
+		cookies.append(wizard)
+		wizard.load()
+	return wizard.buffer(buf)
+
+def fastkey(buf):
+	""" Get the --fast-magic grouping key for file header 'buf'.
+	The header itself is used, so that sorting the groups keeps files
+	starting with the same magic bytes together. """
+	return binascii.hexlify(buf[:64])
+
+def sniff(intar):
+	""" Recognize filetypes of regular files in 'intar' using magic.
+
+	Files are read while walking the archive headers, in the order they are
+	stored, so that the archive is read in a single forward pass. Results
+	are cached by file header, as identical headers are common. Distinct
+	headers are recognized in batches, in parallel.
+
+	With --fast-magic, files are grouped by fastkey() instead. """
+	types = {}
+	cache = {}
+	pending = {} # digest -> (header, files)
+	src = intar.fileobj
+	if opts.fastmagic:
+		hdrlen = 64
+		pool = None
+	else:
+		hdrlen = 4096
+		pool = magicpool
+	# file headers are read into a single reused buffer
+	view = memoryview(bytearray(hdrlen))
+
+	def flush():
+		if not pending:
+			return
+		digests = pending.keys()
+		results = pool.map(recognize, [pending[d][0] for d in digests])
+		for d, key in zip(digests, results):
+			cache[d] = key
+			for f in pending[d][1]:
+				types[f] = key
+		pending.clear()
+
+	for f in intar:
+		ftype = f.type
+		if ftype not in regtypes:
+			continue
+		if f.size == 0:
+			types[f] = ''
+			continue
+
+		if ftype == sparsetype: # data is not stored contiguously
+			buf = memoryview(intar.extractfile(f).read(hdrlen))
+		else:
+			# right after the header, usually in the same read buffer
+			src.seek(f.offset_data)
+			buf = view[:src.readinto(view[:min(hdrlen, f.size)])]
+
+		if pool is None:
+			types[f] = fastkey(buf)
+			continue
+
+		digest = hashlib.sha1(buf).digest()
+		if digest in cache:
+			types[f] = cache[digest]
+		elif digest in pending:
+			pending[digest][1].append(f)
+		else:
+			pending[digest] = (buf.tobytes(), [f])
+			if len(pending) >= 1024:
+				flush()
 
-	if (len(inlist) <= 1):
-		copy(inlist)
-		return
+	flush()
 
-	debug(2, 'grouping %d files (%s) by %s ...' % (len(inlist), key, reorder_by_descs[crit]))
+	if pool is not None:
+		debug(3, '... %d files, %d distinct headers' % (len(types), len(cache)))
 
-	for f in inlist:
-		key = None
+	return types
 
-		if crit == reorder_by.type:
-			if not f.isfile():
-				if f.isdir():
-					before.append(f)
-				else: # symlinks & such
-					after.append(f)
-			else:
-				if opts.usemagic:
-					fc = intar.extractfile(f)
-					key = wizard.buffer(fc.read(4096))
+def reorder(inlist, intar, outtar, types, inmap):
+	""" Perform the reorder of files in 'inlist', refining the groups using
+	subsequent criteria from 'reorder_by'. 'types' maps regular files
+	to their magic-recognized filetypes. 'inmap' is the input archive
+	mapped into memory, or None. """
+	def copy(flist):
+		""" Copy files in 'flist' into new tarball. """
+		verbose = opts.verbose
+		fileobj = outtar.fileobj
+		write = fileobj.write
+		hdrargs = (outtar.format, outtar.encoding, outtar.errors)
+		blocksize = tarfile.BLOCKSIZE
+		nul = tarfile.NUL
+		if inmap is not None:
+			maplen = len(inmap)
+		offset = outtar.offset
+		# headers & padding are queued and written together, as runs
+		# of directories, symlinks etc. have no data in between
+		queue = []
+		maxqueue = bufsize // blocksize
 
-				if key is None: # (or not opts.usemagic) implied
-					key = ''
+		try:
+			for f in flist:
+				if verbose:
+					print f.name
+
+				# like outtar.addfile() but copying in larger blocks
+				buf = f.tobuf(*hdrargs)
+				queue.append(buf)
+				offset += len(buf)
+
+				ftype = f.type
+				size = f.size
+				if ftype in regtypes and size > 0:
+					write(''.join(queue))
+					del queue[:]
+
+					if inmap is not None and ftype != sparsetype:
+						# write the mapped pages without copying them to strings
+						pos = f.offset_data
+						end = pos + size
+						if end > maplen:
+							raise IOError('unexpected end of data')
+						while pos < end:
+							write(buffer(inmap, pos, min(bufsize, end - pos)))
+							pos += bufsize
+					else:
+						copydata(intar.extractfile(f), fileobj, size)
+
+					pad = -size % blocksize
+					queue.append(nul * pad)
+					offset += size + pad
+				elif len(queue) >= maxqueue:
+					write(''.join(queue))
+					del queue[:]
+
+			write(''.join(queue))
+		finally:
+			outtar.offset = offset
+
+	by_type = reorder_by.type
+	by_ext = reorder_by.ext
+	by_name = reorder_by.name
+	by_last = reorder_by.last
+
+	# (files, criteria, group key); criteria of None means 'copy as-is'
+	stack = [(inlist, by_type, '*all*')]
+
+	while stack:
+		(flist, crit, key) = stack.pop()
+
+		if crit is None or len(flist) <= 1:
+			copy(flist)
+			continue
+
+		out = defaultdict(list)
+		before = []
+		after = []
+
+		debug(2, 'grouping %d files (%s) by %s ...' % (len(flist), key, reorder_by_descs[crit]))
 
-		if crit == reorder_by.ext:
-			exts = []
-			name = f.name
-			while 1:
-				(name, ext) = os.path.splitext(name)
-				if ext:
-					exts.append(ext)
+		for f in flist:
+			key = None
+
+			if crit == by_type:
+				ftype = f.type
+				if ftype not in regtypes:
+					if ftype == dirtype:
+						before.append(f)
+					else: # symlinks & such
+						after.append(f)
 				else:
-					break
-
-			# NOTE: we indeed do get the extension list reversed
-			# (i.e. '.tar.bz2' comes as '.bz2.tar') and it is fine
-			# this way we keep '.bz2's near other '.bz2's etc.
-			key = ''.join(exts)
+					key = types.get(f)
+					if key is None: # (or not opts.usemagic) implied
+						key = ''
+
+			elif crit == by_ext:
+				# leading dots do not start an extension (like in splitext())
+				parts = f.name.rpartition('/')[2].lstrip('.').split('.')
+
+				# NOTE: we indeed do get the extension list reversed
+				# (i.e. '.tar.bz2' comes as '.bz2.tar') and it is fine
+				# this way we keep '.bz2's near other '.bz2's etc.
+				if len(parts) > 1:
+					key = '.' + '.'.join(reversed(parts[1:]))
+				else:
+					key = ''
 
-		if crit == reorder_by.name:
-			key	= os.path.split(f.name)[1]
+			elif crit == by_name:
+				key = f.name.rpartition('/')[2]
 
-		if crit == reorder_by.last:
-			before.append(f)
+			elif crit == by_last:
+				before.append(f)
 
-		if key is not None:
-			if not key in out.keys():
-				out[key] = []
-			out[key].append(f)
+			if key is not None:
+				out[key].append(f)
 
-	debug(3, '... got %d files in before, %d in after and %d in %d groups' % (len(before), len(after),
-			len(inlist) - len(before) - len(after), len(out.keys())))
+		debug(3, '... got %d files in before, %d in after and %d in %d groups' % (len(before), len(after),
+				len(flist) - len(before) - len(after), len(out)))
 
-	before.sort()
-	after.sort()
+		before.sort(key = byname)
+		after.sort(key = byname)
 
-	copy(before)
-	for k in sorted(out.keys()):
-		reorder(out[k], crit + 1, intar, outtar, k)
-	copy(after)
+		# the stack is LIFO, so push in reverse order of output
+		stack.append((after, None, None))
+		for k in sorted(out, reverse = True):
+			stack.append((out[k], crit + 1, k))
+		stack.append((before, None, None))
 
 processed = 0
 
@@ -165,20 +349,38 @@ for fn in args:
 		inenc = intar.encoding
 		incls = intar.fileobj.__class__
 
+		if incls is not file:
+			# seeking backwards in a compressed stream restarts decompression,
+			# so decompress it once and read the members from a temporary file
+			debug(2, 'decompressing %s to a temporary file' % fn)
+			spool = tempfile.NamedTemporaryFile(dir = getRealDir(fn))
+			try:
+				intar.fileobj.seek(0)
+				shutil.copyfileobj(intar.fileobj, spool, bufsize)
+				spool.flush()
+				inf = open(spool.name, 'rb', bufsize)
+			finally:
+				# the file is removed but stays open in inf
+				spool.close()
+		else:
+			inf = open(fn, 'rb', bufsize)
+
+		# reopen with a large read buffer, so that walking the headers
+		# and reading the file data following them takes few reads
+		intar.close()
+		intar = tarfile.open(fileobj = inf, mode = 'r:')
+
 		if not opts.out:
 			tmpf = tempfile.NamedTemporaryFile(dir = getRealDir(fn), delete = False)
 			tmpfn = tmpf.name
 			debug(2, 'tempfile: %s' % tmpfn)
 
-			if incls is not file:
-				# sorry, bz2 doesn't like chaining, we need to open by fn
-				keepf = tmpf
-				tmpf = incls(tmpfn, 'wb')
-				keepf.close()
+			# sorry, bz2 doesn't like chaining, we need to open by fn
+			tmpf.close()
 		else:
 			# XXX: let user choose compression
 			tmpfn = opts.out
-			tmpf = incls(tmpfn, 'wb')
+		tmpf = openout(tmpfn, incls)
 		debug(2, 'using %s for output' % str(incls))
 
 		try:
@@ -191,7 +393,20 @@ for fn in args:
 				pass
 
 			try:
-				reorder(intar.getmembers(), reorder_by.type, intar, outtar, '*all*')
+				if opts.usemagic:
+					debug(2, 'recognizing filetypes ...')
+					types = sniff(intar)
+				else:
+					types = {}
+				# already loaded if sniff() walked the archive
+				members = intar.getmembers()
+
+				inmap = mapfile(intar.fileobj)
+				try:
+					reorder(members, intar, outtar, types, inmap)
+				finally:
+					if inmap is not None:
+						inmap.close()
 			except:
 				outtar.close()
 				raise
@@ -199,6 +414,7 @@ for fn in args:
 			tmpf.close()
 			os.unlink(tmpfn)
 			intar.close()
+			inf.close()
 			raise
 		else:
 			if opts.out:
@@ -207,6 +423,7 @@ for fn in args:
 				debug(1, 'reorder finished, replacing %s' % fn)
 
 		intar.close()
+		inf.close()
 		outtar.close()
 
 		tmpf.close()
@@ -221,6 +438,12 @@ for fn in args:
 	else:
 		processed += 1
 
+if opts.usemagic and not opts.fastmagic:
+	magicpool.close()
+	magicpool.join()
+	for wizard in cookies:
+		wizard.close()
+
 if processed != len(args):
 	if not opts.quiet:
 		if processed == 0: